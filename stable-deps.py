@@ -19,13 +19,16 @@
 from __future__ import print_function
 
 import argparse
+import heapq
 import json
 import logging
+import multiprocessing
 import os
 import re
 import sys
 import subprocess
 import types
+from multiprocessing.pool import ThreadPool
 from textwrap import dedent, wrap
 
 
@@ -217,6 +220,98 @@ class JSONDependencyListener(DependencyListener):
         return self._json
 
 
+class PlanDependencyListener(DependencyListener):
+    """Dependency listener for use when working through a queue of
+    candidate commits.  Dependencies of all candidates are collected
+    into a single graph, which plan() turns into one list of commits to
+    apply, in order, with each prerequisite annotated with the
+    candidates which need it.
+    """
+
+    def __init__(self, options):
+        super(PlanDependencyListener, self).__init__(options)
+
+        # Candidates in the order they were given, and the commit
+        # objects for everything we've come across.
+        self._candidates = []
+        self._commits = {}
+
+        # Map dependents to the list of their dependencies, in the order
+        # they were discovered.
+        self._edges = {}
+
+    def add_candidate(self, commit):
+        if commit.hex not in self._candidates:
+            self._candidates.append(commit.hex)
+            self._commits[commit.hex] = commit
+
+    def new_commit(self, commit):
+        self._commits[commit.hex] = commit
+
+    def new_dependency(self, dependent, dependency, path, line_num):
+        deps = self._edges.setdefault(dependent.hex, [])
+        if dependency.hex not in deps:
+            deps.append(dependency.hex)
+
+    def plan(self):
+        """Returns a list of (sha1, candidates) tuples, ordered so that
+        every commit comes after all of its dependencies, where
+        candidates lists the candidates needing that commit.
+        """
+        needed_by = {}
+
+        for candidate in self._candidates:
+            # Walk everything the candidate needs, noting that it does.
+            needed_by.setdefault(candidate, [])
+            seen = set([candidate])
+            stack = [candidate]
+            while stack:
+                for dep in self._edges.get(stack.pop(), []):
+                    if dep in seen:
+                        continue
+                    seen.add(dep)
+                    needed_by.setdefault(dep, []).append(candidate)
+                    stack.append(dep)
+
+        # Topological sort of everything needed, always taking the oldest
+        # commit whose dependencies are all in the plan already, so that
+        # unrelated commits stay in the order they were committed in.
+        pending = {}
+        dependents = {}
+        for sha1 in needed_by:
+            deps = self._edges.get(sha1, [])
+            pending[sha1] = len(deps)
+            for dep in deps:
+                dependents.setdefault(dep, []).append(sha1)
+
+        ready = [(self._commits[sha1].commit_time, sha1)
+                 for sha1 in needed_by if not pending[sha1]]
+        heapq.heapify(ready)
+
+        order = []
+        while ready:
+            commit_time, sha1 = heapq.heappop(ready)
+            order.append(sha1)
+            for dependent in dependents.get(sha1, []):
+                pending[dependent] -= 1
+                if not pending[dependent]:
+                    heapq.heappush(ready, (
+                        self._commits[dependent].commit_time, dependent))
+
+        return [(sha1, needed_by[sha1]) for sha1 in order]
+
+    def print_plan(self):
+        for sha1, candidates in self.plan():
+            subject = self.detector.oneline(self._commits[sha1])
+            if sha1 in self._candidates:
+                print("%s %s (candidate)" % (sha1[:12], subject))
+            else:
+                print("%s %s" % (sha1[:12], subject))
+            if candidates:
+                print("\tneeded by: %s" %
+                      " ".join(c[:12] for c in candidates))
+
+
 class GitUtils(object):
     @classmethod
     def abbreviate_sha1(cls, sha1):
@@ -333,10 +428,17 @@ class DependencyDetector(object):
         # Memoization for branch_contains()
         self.branch_contains_cache = {}
 
+        # Memoization for in_tree()
+        self.in_tree_cache = {}
+
         # Callbacks to be invoked when a new dependency has been
         # discovered.
         self.listeners = []
 
+        # Worker pool for running git blame subprocesses concurrently;
+        # created lazily by blame_pool().
+        self.pool = None
+
     def add_listener(self, listener):
         if not isinstance(listener, DependencyListener):
             raise RuntimeError("Listener must be a DependencyListener")
@@ -386,8 +488,11 @@ class DependencyDetector(object):
         except InvalidCommitish as e:
             abort(e.message())
 
-        self.todo.append(dependent)
-        self.todo_d[dependent.hex] = True
+        # Commits already processed, e.g. when given several commit-ishs
+        # which depend on each other, must not be blamed again.
+        if dependent.hex not in self.done_d:
+            self.todo.append(dependent)
+            self.todo_d[dependent.hex] = True
 
         while self.todo:
             sha1s = [commit.hex[:8] for commit in self.todo]
@@ -398,8 +503,11 @@ class DependencyDetector(object):
                               dependent.hex[:8])
             self.notify_listeners('new_commit', dependent)
 
+            blames = []
             for parent in dependent.parents:
-                self.find_dependencies_with_parent(dependent, parent)
+                blames.extend(
+                    self.find_dependencies_with_parent(dependent, parent))
+            self.run_blames(dependent, blames)
             self.done.append(dependent.hex)
             self.done_d[dependent.hex] = True
             self.logger.debug("Found all dependencies for %s" %
@@ -408,48 +516,84 @@ class DependencyDetector(object):
             dependencies = self.dependencies.get(dependent.hex, {})
             self.notify_listeners('dependent_done', dependent, dependencies)
 
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
         self.notify_listeners('all_done')
 
     def find_dependencies_with_parent(self, dependent, parent):
         """Find all dependencies of the given revision caused by the given
         parent commit.  This will be called multiple times for merge
         commits which have multiple parents.
+
+        Returns a list of (parent, path, hunk, cmd) tuples, one for each
+        hunk which needs blaming, in diff order.  The blames themselves
+        are run by run_blames(), so that all hunks of a commit can be
+        blamed concurrently.
         """
         self.logger.debug("  Finding dependencies of %s via parent %s" %
                           (dependent.hex[:8], parent.hex[:8]))
         diff = self.repo.diff(parent, dependent,
                               context_lines=self.options.context_lines)
+        blames = []
         for patch in diff:
             path = patch.delta.old_file.path
             self.logger.debug("    Examining hunks in %s" % path)
+
+            if not self.tree_lookup(path, parent):
+                # This is probably because dependent added a new directory
+                # which was not previously in the parent.
+                continue
+
             for hunk in patch.hunks:
-                self.blame_hunk(dependent, parent, path, hunk)
-
-    def blame_hunk(self, dependent, parent, path, hunk):
-        """Run git blame on the parts of the hunk which exist in the older
-        commit in the diff.  The commits generated by git blame are
-        the commits which the newer commit in the diff depends on,
-        because without the lines from those commits, the hunk would
-        not apply correctly.
+                cmd = self.blame_cmd(parent, path, hunk)
+                blames.append((parent, path, hunk, cmd))
+        return blames
+
+    def blame_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(self.options.jobs)
+        return self.pool
+
+    def run_blames(self, dependent, blames):
+        """Run the git blame commands for the given hunks concurrently,
+        handing the results to blame_hunk() in the original diff order
+        so that listeners see the same sequence of events as with a
+        serial run.
         """
-        first_line_num = hunk.old_start
-        line_range_before = "-%d,%d" % (hunk.old_start, hunk.old_lines)
-        line_range_after  = "+%d,%d" % (hunk.new_start, hunk.new_lines)
-        self.logger.debug("      Blaming hunk %s @ %s" %
-                          (line_range_before, parent.hex[:8]))
+        cmds = [cmd for parent, path, hunk, cmd in blames]
+        if self.options.jobs > 1 and len(cmds) > 1:
+            outputs = self.blame_pool().imap(subprocess.check_output, cmds)
+        else:
+            outputs = (subprocess.check_output(cmd) for cmd in cmds)
 
-        if not self.tree_lookup(path, parent):
-            # This is probably because dependent added a new directory
-            # which was not previously in the parent.
-            return
+        for (parent, path, hunk, cmd), blame in zip(blames, outputs):
+            self.blame_hunk(dependent, parent, path, hunk, blame)
 
-        cmd = [
+    def blame_cmd(self, parent, path, hunk):
+        """Returns the git blame command covering the parts of the hunk
+        which exist in the older commit in the diff.
+        """
+        return [
             'git', 'blame',
             '--porcelain',
             '-L', "%d,+%d" % (hunk.old_start, hunk.old_lines),
             parent.hex, '--', path
         ]
-        blame = subprocess.check_output(cmd)
+
+    def blame_hunk(self, dependent, parent, path, hunk, blame):
+        """Process the output of git blame on the parts of the hunk which
+        exist in the older commit in the diff.  The commits generated by
+        git blame are the commits which the newer commit in the diff
+        depends on, because without the lines from those commits, the
+        hunk would not apply correctly.
+        """
+        first_line_num = hunk.old_start
+        line_range_before = "-%d,%d" % (hunk.old_start, hunk.old_lines)
+        line_range_after  = "+%d,%d" % (hunk.new_start, hunk.new_lines)
+        self.logger.debug("      Blaming hunk %s @ %s" %
+                          (line_range_before, parent.hex[:8]))
 
         dependent_sha1 = dependent.hex
         if dependent_sha1 not in self.dependencies:
@@ -478,31 +622,40 @@ class DependencyDetector(object):
                 continue
 
             if dependency_sha1 not in self.dependencies[dependent_sha1]:
+                seen = False
                 if dependency_sha1 in self.todo_d:
                     self.logger.debug(
                         '        Dependency %s via line %s already in TODO' %
                         (dependency_sha1[:8], line_num,))
-                    continue
-
-                if dependency_sha1 in self.done_d:
+                    seen = True
+                elif dependency_sha1 in self.done_d:
                     self.logger.debug(
                         '        Dependency %s via line %s already done' %
                         (dependency_sha1[:8], line_num,))
+                    seen = True
+
+                # In queue mode, record the edge even if the dependency
+                # has already been seen, so that commits shared by several
+                # dependents are attributed to all of them.
+                if seen and not self.options.queue:
                     continue
 
-                self.logger.debug(
-                    '        New dependency %s via line %s (%s)' %
-                    (dependency_sha1[:8], line_num, self.oneline(dependency)))
                 self.dependencies[dependent_sha1][dependency_sha1] = {}
-                self.notify_listeners('new_commit', dependency)
-                self.notify_listeners('new_dependency',
-                                      dependent, dependency, path, line_num)
-                if dependency_sha1 not in self.dependencies:
+
+                if not seen:
+                    self.logger.debug(
+                        '        New dependency %s via line %s (%s)' %
+                        (dependency_sha1[:8], line_num,
+                         self.oneline(dependency)))
+                    self.notify_listeners('new_commit', dependency)
                     if self.options.recurse:
                         self.todo.append(dependency)
                         self.todo_d[dependency.hex] = True
                         self.logger.debug('          added to TODO')
 
+                self.notify_listeners('new_dependency',
+                                      dependent, dependency, path, line_num)
+
             dep_sources = self.dependencies[dependent_sha1][dependency_sha1]
 
             if path not in dep_sources:
@@ -539,8 +692,24 @@ class DependencyDetector(object):
             for exclude in self.options.exclude_commits:
                 if self.branch_contains(commit, exclude):
                     return True
+        if self.options.queue and self.in_tree(commit):
+            return True
         return False
 
+    def in_tree(self, commit):
+        """Returns whether the given commit is already in the current
+        branch, either as is or as a backport with the same subject.
+        This is decided by stable-commit-in-tree.
+        """
+        sha1 = commit.hex
+        if sha1 not in self.in_tree_cache:
+            here = os.path.dirname(os.path.realpath(__file__))
+            cmd = [os.path.join(here, 'stable-commit-in-tree'), sha1]
+            result = subprocess.call(cmd) == 1
+            self.logger.debug("        %s in tree: %s" % (sha1[:8], result))
+            self.in_tree_cache[sha1] = result
+        return self.in_tree_cache[sha1]
+
     def branch_contains(self, commit, branch):
         sha1 = commit.hex
         branch_commit = self.get_commit(branch)
@@ -626,6 +795,10 @@ def parse_args():
                         help='Port number for webserver [%(default)s]')
     parser.add_argument('-r', '--recurse', dest='recurse', action='store_true',
                         help='Follow dependencies recursively')
+    parser.add_argument('-q', '--queue', dest='queue', action='store_true',
+                        help='Treat the given commits as a backport queue: '
+                        'skip commits already in the current branch and '
+                        'print a single ordered plan of commits to apply')
     parser.add_argument('-e', '--exclude-commits', dest='exclude_commits',
                         action='append', metavar='COMMITISH',
                         help='Exclude commits which are ancestors of the '
@@ -634,12 +807,28 @@ def parse_args():
                         type=int, metavar='NUM', default=1,
                         help='Number of lines of diff context to use '
                         '[%(default)s]')
+    parser.add_argument('--jobs', dest='jobs', type=int, metavar='NUM',
+                        default=multiprocessing.cpu_count(),
+                        help='Number of git blame processes to run '
+                        'concurrently [%(default)s]')
     parser.add_argument('-d', '--debug', dest='debug', action='store_true',
                         help='Show debugging')
 
     options, args = parser.parse_known_args()
 
+    if options.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+
+    if options.queue:
+        if options.log:
+            parser.error('--log does not make sense in queue mode.')
+        if options.json:
+            parser.error('--json does not make sense in queue mode.')
+        options.recurse = True
+
     if options.serve:
+        if options.queue:
+            parser.error('--queue does not make sense in webserver mode.')
         if options.log:
             parser.error('--log does not make sense in webserver mode.')
         if options.json:
@@ -661,12 +850,23 @@ def cli(options, args):
 
     if options.json:
         listener = JSONDependencyListener(options)
+    elif options.queue:
+        listener = PlanDependencyListener(options)
     else:
         listener = CLIDependencyListener(options)
 
     detector.add_listener(listener)
 
     for dependent_rev in args:
+        if options.queue:
+            try:
+                dependent = detector.get_commit(dependent_rev)
+            except InvalidCommitish as e:
+                abort(e.message())
+            if detector.in_tree(dependent):
+                continue
+            listener.add_candidate(dependent)
+
         try:
             detector.find_dependencies(dependent_rev)
         except KeyboardInterrupt:
@@ -674,6 +874,8 @@ def cli(options, args):
 
     if options.json:
         print(json.dumps(listener.json(), sort_keys=True, indent=4))
+    elif options.queue:
+        listener.print_plan()
 
 
 def serve(options):
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+#
+# Look up commits whose subject line is similar to that of a given commit,
+# using an index of normalized subject lines of the local branch and
+# OTHER_STABLE_TREES.  This catches backports whose subject was edited, for
+# example by adding a "[PATCH 4.14]" or "BACKPORT:" prefix.
+#
+
+from __future__ import print_function
+
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+
+
+# Prefixes added to subjects of backports and reverts, which are stripped
+# (repeatedly) before comparing subjects.
+PREFIX_RE = re.compile(r'''
+    ^\s*(
+        \[[^\]]*\]                  # [PATCH 4.14], [backport], ...
+      | (backport|fromgit|fromlist|upstream|cherry-pick|android|chromium)
+        (\s*\([^)]*\))?\s*:         # BACKPORT:, FROMGIT:, UPSTREAM(4.9):
+      | revert\s+(?=")              # Revert "..."
+    )''', re.IGNORECASE | re.VERBOSE)
+
+REVERT_RE = re.compile(r'^\s*revert\s+"', re.IGNORECASE)
+
+TOKEN_RE = re.compile(r'[a-z0-9_]+')
+
+# Scores of matches which revert the queried change (or are reverted by it)
+# are scaled by this, so they don't pass as alternates.
+REVERT_PENALTY = 0.5
+
+# How many of the query's rarest tokens are used to find candidates.
+LOOKUP_TOKENS = 4
+
+
+def abort(msg, exitcode=1):
+    print(msg, file=sys.stderr)
+    sys.exit(exitcode)
+
+
+def git(*args):
+    out = subprocess.check_output(('git',) + args)
+    return out.decode('utf-8', 'replace')
+
+
+def strip_prefixes(subject):
+    """Strips backport prefixes from the given subject, returning what's
+    left along with the number of "Revert" prefixes stripped.
+    """
+    reverts = 0
+    while True:
+        if REVERT_RE.match(subject):
+            reverts += 1
+        stripped = PREFIX_RE.sub('', subject, count=1)
+        if stripped == subject:
+            return subject, reverts
+        subject = stripped
+
+
+def normalize(subject):
+    """Strips backport prefixes from the given subject and folds case,
+    punctuation and whitespace, returning the list of words left.
+    """
+    return TOKEN_RE.findall(strip_prefixes(subject)[0].lower())
+
+
+def is_revert(subject):
+    return strip_prefixes(subject)[1] % 2 == 1
+
+
+class SubjectIndex(object):
+    """An sqlite backed index mapping the words of normalized subject lines
+    to the commits carrying them.  The index remembers the tips of the refs
+    it was built from, and is brought up to date incrementally.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS commits (
+                id INTEGER PRIMARY KEY, sha1 TEXT UNIQUE, subject TEXT,
+                normalized TEXT);
+            CREATE TABLE IF NOT EXISTS tokens (
+                token TEXT, commit_id INTEGER);
+            CREATE INDEX IF NOT EXISTS tokens_token ON tokens (token);
+            CREATE INDEX IF NOT EXISTS tokens_commit ON tokens (commit_id);
+            CREATE INDEX IF NOT EXISTS commits_normalized
+                ON commits (normalized);
+        ''')
+
+    def tips(self):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'tips'").fetchone()
+        return json.loads(row[0]) if row else []
+
+    def update(self, refs):
+        """Adds commits which became reachable from the given refs since
+        the last update, and drops the ones which no longer are (e.g.
+        because the local branch was rebased).
+        """
+        tips = sorted(set(git('rev-parse', *refs).split()))
+        old_tips = self.tips()
+        if tips == old_tips:
+            return
+
+        # The old tips might have been garbage collected, in which case
+        # we have to start from scratch.
+        try:
+            for tip in old_tips:
+                git('cat-file', '-e', tip)
+        except subprocess.CalledProcessError:
+            old_tips = []
+            self.db.execute("DELETE FROM commits")
+            self.db.execute("DELETE FROM tokens")
+
+        if old_tips:
+            gone = git('rev-list', *(old_tips + ['--not'] + tips)).split()
+            for sha1 in gone:
+                self.remove(sha1)
+
+        log = git('log', '--format=%H %s', *(tips + ['--not'] + old_tips))
+        for line in log.splitlines():
+            sha1, _, subject = line.partition(' ')
+            self.add(sha1, subject)
+
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tips', ?)",
+                        (json.dumps(tips),))
+        self.db.commit()
+
+    def add(self, sha1, subject):
+        words = normalize(subject)
+        cur = self.db.execute(
+            "INSERT OR IGNORE INTO commits (sha1, subject, normalized) "
+            "VALUES (?, ?, ?)", (sha1, subject, ' '.join(words)))
+        if cur.rowcount:
+            self.db.executemany(
+                "INSERT INTO tokens VALUES (?, ?)",
+                [(word, cur.lastrowid) for word in set(words)])
+
+    def remove(self, sha1):
+        row = self.db.execute(
+            "SELECT id FROM commits WHERE sha1 = ?", (sha1,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM tokens WHERE commit_id = ?", row)
+            self.db.execute("DELETE FROM commits WHERE id = ?", row)
+
+    def lookup(self, subject):
+        """Returns a list of (score, exact, sha1, subject, revert) tuples
+        for commits with a subject similar to the given one, best match
+        first.  revert is set for matches which undo the given subject's
+        change, or the other way around.
+        """
+        words = normalize(subject)
+        normalized = ' '.join(words)
+
+        # Find candidates through the query's rarest words, common ones
+        # like the subsystem prefix would match half of the history.
+        counts = []
+        for word in set(words):
+            n = self.db.execute(
+                "SELECT COUNT(*) FROM tokens WHERE token = ?",
+                (word,)).fetchone()[0]
+            if n:
+                counts.append((n, word))
+        rare = [word for n, word in sorted(counts)[:LOOKUP_TOKENS]]
+
+        ids = set(row[0] for row in self.db.execute(
+            "SELECT id FROM commits WHERE normalized = ?", (normalized,)))
+        if rare:
+            ids.update(row[0] for row in self.db.execute(
+                "SELECT commit_id FROM tokens WHERE token IN (%s) "
+                "GROUP BY commit_id HAVING COUNT(*) >= ? "
+                "ORDER BY COUNT(*) DESC LIMIT 1000" %
+                ", ".join("?" * len(rare)),
+                rare + [(len(rare) + 1) // 2]))
+
+        revert = is_revert(subject)
+        results = []
+        for commit_id in ids:
+            sha1, other, other_normalized = self.db.execute(
+                "SELECT sha1, subject, normalized FROM commits WHERE id = ?",
+                (commit_id,)).fetchone()
+            score = difflib.SequenceMatcher(
+                None, normalized, other_normalized).ratio()
+            other_revert = is_revert(other) != revert
+            if other_revert:
+                score *= REVERT_PENALTY
+            results.append((score, other == subject, sha1, other,
+                            other_revert))
+
+        results.sort(key=lambda r: (r[1], r[0]), reverse=True)
+        return results
+
+
+def index_path():
+    """Returns the location of the index for the current repository."""
+    cache = os.environ.get('STABLE_CHECKPOINT_DIR',
+                           os.path.expanduser('~/.cache/stable-tools'))
+    git_dir = os.path.realpath(git('rev-parse', '--git-common-dir').strip())
+    key = hashlib.md5(git_dir.encode('utf-8')).hexdigest()
+    path = os.path.join(cache, 'subject-index')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, key + '.db')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Shows commits in the local branch and '
+                    'OTHER_STABLE_TREES with a subject similar to that '
+                    'of the given commit.')
+    parser.add_argument('commit', metavar='COMMIT-ISH')
+    parser.add_argument('-n', '--max-count', dest='max_count', type=int,
+                        metavar='NUM', default=10,
+                        help='Show at most NUM matches [%(default)s]')
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float,
+                        metavar='SCORE', default=0.6,
+                        help='Hide matches scoring below SCORE, between '
+                        '0 and 1 [%(default)s]')
+    parser.add_argument('-l', '--local', dest='local', action='store_true',
+                        help='Only show matches in the current branch')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+
+    try:
+        sha1 = git('rev-parse', '--verify', '-q',
+                   options.commit + '^{commit}').strip()
+    except subprocess.CalledProcessError:
+        abort("Couldn't resolve commitish %s" % options.commit)
+    subject = git('log', '-1', '--format=%s', sha1).strip()
+
+    refs = ['HEAD'] + os.environ.get('OTHER_STABLE_TREES', '').split()
+    for ref in refs:
+        try:
+            git('rev-parse', '--verify', '-q', ref + '^{commit}')
+        except subprocess.CalledProcessError:
+            abort("Couldn't resolve %s from OTHER_STABLE_TREES" % ref)
+    index = SubjectIndex(index_path())
+    index.update(refs)
+
+    shown = 0
+    for score, exact, other, other_subject, revert in index.lookup(subject):
+        if shown == options.max_count or score < options.threshold:
+            break
+        if other == sha1:
+            continue
+        if options.local and subprocess.call(
+                ['git', 'merge-base', '--is-ancestor', other, 'HEAD']) != 0:
+            continue
+        print("%.2f %s %s%s" % (score, other[:12], other_subject,
+                                " (revert)" if revert else ""))
+        shown += 1
+
+
+if __name__ == "__main__":
+    main()